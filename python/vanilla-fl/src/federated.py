@@ -9,9 +9,35 @@ import torchvision.transforms as transforms
 from datetime import datetime
 import time
 import random
+from typing import Optional
+from contextlib import nullcontext
 from models import CNNMnist
 import utils
-import json
+
+def train_step(model, optimizer, scaler, criterion, images, labels, device, amp_dtype):
+    """
+    Run one optimization step of a client model on a batch.
+
+    :param model: Client model to train.
+    :param optimizer: Optimizer over the client model's parameters.
+    :param scaler: GradScaler for the loss (a no-op unless training in float16).
+    :param criterion: Loss function.
+    :param images: Batch of input images.
+    :param labels: Batch of target labels.
+    :param device: Device the model runs on.
+    :param amp_dtype: Autocast dtype, or None to run without autocast.
+    :return: Detached loss of the batch, left on the device.
+    """
+    images, labels = images.to(device, non_blocking=True), labels.to(device, non_blocking=True)
+    images = images.to(memory_format=torch.channels_last)
+    optimizer.zero_grad()
+    with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+        outputs = model(images)
+        loss = criterion(outputs, labels)
+    scaler.scale(loss).backward()
+    scaler.step(optimizer)
+    scaler.update()
+    return loss.detach()
 
 def main(RANDOM_SEED: int = 42,
          NUM_CLIENTS: int = 3,
@@ -21,7 +47,13 @@ def main(RANDOM_SEED: int = 42,
          NUM_ROUNDS: int = 10,
          EPOCHS_PER_CLIENT: int = 10,
          CLIENT_FRACTION: float = 0.5,
-         LEARNING_RATE : float = 0.01):
+         LEARNING_RATE : float = 0.01,
+         CLIENT_NUM_WORKERS: int = 0,
+         QUANTIZE_UPDATES: bool = False,
+         TOPK_FRACTION: Optional[float] = None,
+         UPDATE_KEEP_FRACTION: float = 1.0,
+         PARALLEL_CLIENTS: bool = False,
+         DEBUG_DUMP: bool = False):
     
     # to calculate execution time
     start_time = time.time()
@@ -36,6 +68,15 @@ def main(RANDOM_SEED: int = 42,
     logging.info(f"NUM_ROUNDS: {NUM_ROUNDS}")
     logging.info(f"EPOCHS_PER_CLIENT: {EPOCHS_PER_CLIENT}")
     logging.info(f"CLIENT_FRACTION: {CLIENT_FRACTION}")
+    logging.info(f"CLIENT_NUM_WORKERS: {CLIENT_NUM_WORKERS}")
+    logging.info(f"QUANTIZE_UPDATES: {QUANTIZE_UPDATES}")
+    logging.info(f"TOPK_FRACTION: {TOPK_FRACTION}")
+    logging.info(f"UPDATE_KEEP_FRACTION: {UPDATE_KEEP_FRACTION}")
+    logging.info(f"PARALLEL_CLIENTS: {PARALLEL_CLIENTS}")
+    logging.info(f"DEBUG_DUMP: {DEBUG_DUMP}")
+
+    if not 0 < UPDATE_KEEP_FRACTION <= 1:
+        raise ValueError(f"UPDATE_KEEP_FRACTION must be in (0, 1], got {UPDATE_KEEP_FRACTION}")
 
     # Set seed for reproducibility
     torch.manual_seed(RANDOM_SEED)
@@ -65,10 +106,59 @@ def main(RANDOM_SEED: int = 42,
     # Check if CUDA is available, if not use CPU
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     logging.info(f'Using device: {device}')
+    utils.configure_backends()
+    amp_dtype = utils.autocast_dtype(device)
+
+    # Build each client's DataLoader once instead of every round. The batch
+    # sampler yields EPOCHS_PER_CLIENT epochs, each a separately batched
+    # permutation, so all local epochs run in a single pass over the loader with
+    # the same number of steps per epoch as before. Loading stays in-process by
+    # default (CLIENT_NUM_WORKERS=0): workers are not persistent, so any workers
+    # would be restarted for every client pass, which costs more than a short
+    # pass gains.
+    client_loaders = {}
+    for client_id in range(NUM_CLIENTS):
+        client_subset = Subset(train_dataset, dict_users[client_id])
+        client_sampler = utils.EpochBatchSampler(len(client_subset),
+                                                 batch_size=64,
+                                                 epochs=EPOCHS_PER_CLIENT)
+        client_loaders[client_id] = DataLoader(client_subset,
+                                               batch_sampler=client_sampler,
+                                               num_workers=CLIENT_NUM_WORKERS,
+                                               pin_memory=(device.type == 'cuda'),
+                                               prefetch_factor=4 if CLIENT_NUM_WORKERS > 0 else None)
 
     # Initialize the global model
-    global_model = CNNMnist().to(device)
+    # Not compiled: it only runs a single evaluation pass, which wouldn't repay the compile time
+    global_model = CNNMnist().to(device).to(memory_format=torch.channels_last)
     logging.info("Global model initialized.")
+
+    # Determine the number of clients to sample
+    num_clients_sample = max(1, int(NUM_CLIENTS * CLIENT_FRACTION))
+
+    # Sampled clients can train concurrently on separate CUDA streams. Each
+    # concurrent client needs its own model, so peak memory grows with the
+    # number of sampled clients. This is incompatible with the CUDA-graph
+    # ('reduce-overhead') compile mode: its graphs share one memory pool and
+    # assume replays run one at a time on one stream, so concurrent clients
+    # could overwrite each other's buffers. Parallel clients are compiled
+    # without CUDA graphs instead.
+    parallel_clients = PARALLEL_CLIENTS and device.type == 'cuda'
+    if PARALLEL_CLIENTS and not parallel_clients:
+        logging.warning("PARALLEL_CLIENTS requires CUDA; training clients sequentially.")
+
+    # Client models are compiled once (on GPU only) and reused by every client across rounds
+    criterion = nn.CrossEntropyLoss()
+    client_slots = []
+    for _ in range(num_clients_sample if parallel_clients else 1):
+        local_model = CNNMnist().to(device).to(memory_format=torch.channels_last)
+        if device.type == 'cuda':
+            local_model.compile(mode='default' if parallel_clients else 'reduce-overhead', fullgraph=True)
+        optimizer = torch.optim.Adam(local_model.parameters(), 
+                                     lr=LEARNING_RATE, 
+                                     weight_decay=1e-4)
+        stream = torch.cuda.Stream() if parallel_clients else None
+        client_slots.append((local_model, optimizer, stream))
     
     # Training loop for federated learning
     logging.info("Starting federated training...")
@@ -81,63 +171,93 @@ def main(RANDOM_SEED: int = 42,
         
         # Copy global weights
         global_weights = global_model.state_dict()
+        global_vector = global_model.weights_to_vector().clone()
 
         local_weights = []
-        local_weights_copy = []
-        local_losses = []
+        update_norms = []
+        round_loss_sum = 0.0
 
-        # Determine the number of clients to sample
-        num_clients_sample = max(1, int(NUM_CLIENTS * CLIENT_FRACTION))
         sampled_clients = random.sample(range(NUM_CLIENTS), num_clients_sample)
         sampled_clients.sort()
         logging.info(f"Sampled clients: {sampled_clients}")
 
-        for client_id in sampled_clients:
-            local_model = CNNMnist().to(device)
-            
-            # Broadcasting Global Model
-            local_model.load_state_dict(global_weights)
-
-            # Create DataLoader for the client's data subset
-            client_indices = dict_users[client_id]
-            client_subset = Subset(train_dataset, client_indices)
-            client_loader = DataLoader(client_subset, batch_size=64, shuffle=True)
-
-            # Train the local model
-            optimizer = torch.optim.Adam(local_model.parameters(), 
-                                        lr=LEARNING_RATE, 
-                                        weight_decay=1e-4)
-            criterion = nn.CrossEntropyLoss()
-            local_model.train()
-            client_epoch_loss = []
-
-            for epoch in range(EPOCHS_PER_CLIENT):
-                for images, labels in client_loader:
-                    images, labels = images.to(device), labels.to(device)
-                    optimizer.zero_grad()
-                    outputs = local_model(images)
-                    loss = criterion(outputs, labels)
-                    loss.backward()
-                    optimizer.step()
-                    client_epoch_loss.append(loss.item())
-                    
-            
-            avg_local_loss = sum(client_epoch_loss) / len(client_epoch_loss)
-            local_losses.append(avg_local_loss)
-            
-            # collect local weights from the clients
-            local_weights.append(local_model.weights_to_vector())
-            local_weights_copy.append(local_model.weights_to_vector().tolist())
-            
-            # logging.info('Local updates collected as a vector.')
+        # Clients train in waves: all at once on separate streams, or one at a time
+        waves = [sampled_clients] if parallel_clients else [[client_id] for client_id in sampled_clients]
+
+        for wave in waves:
+            client_loss = []
+            client_batches = []
+            client_scalers = []
+            for local_model, optimizer, stream in client_slots[:len(wave)]:
+                # Broadcasting Global Model
+                local_model.load_state_dict(global_weights)
+                # Start each client from fresh optimizer state and loss scale
+                optimizer.state.clear()
+                client_scalers.append(torch.amp.GradScaler('cuda', enabled=amp_dtype == torch.float16))
+                local_model.train()
+                client_loss.append(torch.zeros((), device=device))
+                client_batches.append(0)
+                if stream is not None:
+                    stream.wait_stream(torch.cuda.current_stream())
+
+            # Train the local models, interleaving batches so concurrent clients overlap
+            client_iters = {i: iter(client_loaders[client_id]) for i, client_id in enumerate(wave)}
+            while client_iters:
+                for i in list(client_iters):
+                    batch = next(client_iters[i], None)
+                    if batch is None:
+                        del client_iters[i]
+                        continue
+                    local_model, optimizer, stream = client_slots[i]
+                    with torch.cuda.stream(stream) if stream is not None else nullcontext():
+                        client_loss[i] += train_step(local_model, optimizer, client_scalers[i], criterion,
+                                                     *batch, device, amp_dtype)
+                    client_batches[i] += 1
+            if parallel_clients:
+                torch.cuda.synchronize()
+
+            # One host sync per wave for all of its clients' average losses
+            avg_local_losses = torch.stack([loss_sum / n_batches
+                                            for loss_sum, n_batches in zip(client_loss, client_batches)]).tolist()
 
-            logging.info(f"Client {client_id + 1} - Average Loss: {avg_local_loss:.6f}")
+            for i, (client_id, avg_local_loss) in enumerate(zip(wave, avg_local_losses)):
+                local_model = client_slots[i][0]
+                round_loss_sum += avg_local_loss
+                
+                # collect local updates from the clients: top-k sparse INT8 deltas if
+                # TOPK_FRACTION is set, dense INT8 deltas if QUANTIZE_UPDATES is set,
+                # otherwise exact dense deltas
+                local_vector = local_model.weights_to_vector()
+                local_delta = local_vector - global_vector
+                update_norms.append(local_delta.norm())
+                if TOPK_FRACTION is not None:
+                    local_weights.append(utils.sparsify_topk(local_delta, TOPK_FRACTION))
+                elif QUANTIZE_UPDATES:
+                    local_weights.append(utils.quantize_int8(local_delta))
+                else:
+                    local_weights.append(local_delta)
+                
+                # logging.info('Local updates collected as a vector.')
+
+                logging.info(f"Client {client_id + 1} - Average Loss: {avg_local_loss:.6f}")
             
         # Calculate average loss for the round
-        avg_loss = sum(local_losses) / len(local_losses)
+        avg_loss = round_loss_sum / len(sampled_clients)
         round_avg_losses.append(avg_loss)
         logging.info(f"Round {round_num + 1} - Average Loss: {avg_loss:.6f}")
         
+        # Only the clients with the largest updates are aggregated
+        num_updates_kept = max(1, round(len(local_weights) * UPDATE_KEEP_FRACTION))
+        if num_updates_kept < len(local_weights):
+            kept = torch.stack(update_norms).topk(num_updates_kept).indices.tolist()
+            local_weights = [local_weights[i] for i in sorted(kept)]
+            logging.info(f"Aggregating the {num_updates_kept} largest of {len(update_norms)} client updates.")
+
+        # Write local updates to disk for debugging
+        if DEBUG_DUMP:
+            torch.save(local_weights, f'local_updates_round_{round_num + 1}.pt')
+            logging.info(f"Local updates for round {round_num + 1} written to file.")
+
         # Aggregate the local weights to update the global model
         global_weights = utils.aggregate_weights(existing_global_weights=global_model.state_dict(), 
                                        local_weights=local_weights)
@@ -146,11 +266,6 @@ def main(RANDOM_SEED: int = 42,
         logging.info('Global weights updated.')
         print("")
         
-    #  # Write local updates to a JSON file
-    # with open(f'local_updates.json', 'w') as f:
-    #     json.dump(local_weights_copy, f)
-    # # logging.info(f"Local updates for round {round_num + 1} written to JSON file.")
-
     logging.info("Federated training completed.")
     
     
@@ -172,7 +287,12 @@ def main(RANDOM_SEED: int = 42,
 
     # Evaluate the global model
     logging.info("Evaluating the global model on the test dataset...")
-    test_loader = DataLoader(test_dataset, batch_size=64, shuffle=False)
+    test_loader = DataLoader(test_dataset,
+                             batch_size=64,
+                             shuffle=False,
+                             num_workers=2,
+                             pin_memory=(device.type == 'cuda'),
+                             prefetch_factor=4)
     test_accuracy, test_loss = utils.evaluate_model(global_model, test_loader, device)
     logging.info(f"Test on {len(test_dataset)} samples")
     logging.info(f"Test Accuracy: {100 * test_accuracy:.2f}%")
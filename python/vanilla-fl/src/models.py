@@ -1,6 +1,7 @@
 from torch import nn
 import torch.nn.functional as F
 import logging
+import numpy as np
 import torch
 
 # Configure logging
@@ -13,34 +14,54 @@ class CNNMnist(nn.Module):
         super(CNNMnist, self).__init__()
         self.conv1 = nn.Conv2d(num_channels, 10, kernel_size=5)
         self.conv2 = nn.Conv2d(10, 20, kernel_size=5)
-        self.conv2_drop = nn.Dropout2d()
+        self.conv2_drop = nn.Dropout2d(inplace=True)
         self.fc1 = nn.Linear(320, 50)
+        self.drop_fc = nn.Dropout(p=0.5, inplace=True)
         self.fc2 = nn.Linear(50, num_classes)
+
+        # Cache parameter layout so flattening doesn't re-derive it each call
+        self._shapes = [p.shape for p in self.parameters()]
+        self._numels = [p.numel() for p in self.parameters()]
+        self._offsets = np.cumsum([0] + self._numels)
+        self._flat = None
         
         logging.debug(f"Initialized CNNMnist with conv1: {self.conv1}, conv2: {self.conv2}, fc1: {self.fc1}, fc2: {self.fc2}")
 
     def forward(self, x):
-        x = F.relu(F.max_pool2d(self.conv1(x), 2))
-        x = F.relu(F.max_pool2d(self.conv2_drop(self.conv2(x)), 2))
-        x = x.view(-1, x.shape[1] * x.shape[2] * x.shape[3])
-        x = F.relu(self.fc1(x))
-        x = F.dropout(x, training=self.training)
+        x = F.relu(F.max_pool2d(self.conv1(x), 2), inplace=True)
+        x = F.relu(F.max_pool2d(self.conv2_drop(self.conv2(x)), 2), inplace=True)
+        # reshape rather than view: activations may be channels_last
+        x = x.reshape(-1, x.shape[1] * x.shape[2] * x.shape[3])
+        # Dropout before ReLU (equivalent, as dropout only zeroes and rescales) so both can
+        # run in place: ReLU's backward needs its output, which an in-place dropout would overwrite
+        x = self.drop_fc(self.fc1(x))
+        x = F.relu(x, inplace=True)
         x = self.fc2(x)
         return F.log_softmax(x, dim=1)
     
     def weights_to_vector(self):
-        """Returns a single vector with all model weights."""
-        return torch.cat([param.view(-1) for param in self.parameters()])
+        """
+        Returns a single vector with all model weights.
+
+        The vector is a buffer reused across calls; clone it if it must outlive
+        the next call.
+        """
+        device = next(self.parameters()).device
+        if self._flat is None or self._flat.device != device:
+            self._flat = torch.empty(int(self._offsets[-1]), device=device)
+        for param, offset, numel, shape in zip(self.parameters(), self._offsets, self._numels, self._shapes):
+            # Copy through a shaped view so channels_last parameters are flattened in logical order
+            self._flat[offset:offset + numel].view(shape).copy_(param.detach())
+        return self._flat
 
     def vector_to_weights(self, vector):
         """Load a single vector back into model's original weight shapes."""
-        pointer = 0
-        for param in self.parameters():
-            numel = param.numel()  # number of elements in this parameter
-            param_shape = param.shape  # shape of the parameter
-            param.data = vector[pointer:pointer + numel].view(param_shape)
-            pointer += numel
+        chunks = torch.split(vector, self._numels)
+        with torch.no_grad():
+            # Copy in place so the parameters (and any optimizer holding them) are preserved
+            torch._foreach_copy_(list(self.parameters()),
+                                 [chunk.view(shape) for chunk, shape in zip(chunks, self._shapes)])
             
     def zero_out_weights(self):
-        for param in self.parameters():
-            param.data.fill_(0)
+        with torch.no_grad():
+            torch._foreach_zero_(list(self.parameters()))
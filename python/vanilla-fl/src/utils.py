@@ -3,7 +3,7 @@ import logging
 import json
 import torch
 from torch import nn
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
@@ -57,8 +57,6 @@ def sample_noniid(num_clients: int,
     logging.info("Loading data from dataset object.")
 
     # Initialize variables
-    idx_shard = [i for i in range(num_shards)]
-    dict_users = {i: np.array([], dtype=np.int64) for i in range(num_clients)}
     total_imgs = num_shards * num_imgs
     
     # random seed
@@ -67,8 +65,8 @@ def sample_noniid(num_clients: int,
     # Ensure that the dataset has enough data
     if total_imgs > len(dataset):
         raise ValueError(f"Dataset does not have enough samples. Required: {total_imgs}, Available: {len(dataset)}")
-
-    idxs = np.arange(total_imgs)
+    if num_clients * shards_per_client > num_shards:
+        raise ValueError(f"Not enough shards. Required: {num_clients * shards_per_client}, Available: {num_shards}")
 
     # Extract labels from the dataset
     if hasattr(dataset, 'targets'):
@@ -78,25 +76,74 @@ def sample_noniid(num_clients: int,
     else:
         raise ValueError("The dataset does not have a recognized attribute for labels")
 
-    # Align indices with their corresponding labels
-    idxs_labels = np.vstack((idxs, labels[:total_imgs]))
-    idxs_labels = idxs_labels[:, idxs_labels[1, :].argsort()]
-    idxs = idxs_labels[0, :]
-    
-    # Shuffle indices
-    np.random.shuffle(idxs)
+    # Sort indices by their corresponding labels so each shard holds only one or two labels
+    idxs = np.argsort(labels[:total_imgs], kind='stable')
 
-    # Assign shards to each client
-    for i in range(num_clients):
-        rand_set = set(rng.choice(idx_shard, shards_per_client, replace=False))
-        idx_shard = list(set(idx_shard) - rand_set)
-        for rand in rand_set:
-            dict_users[i] = np.concatenate(
-                (dict_users[i], idxs[rand * num_imgs:(rand + 1) * num_imgs]), axis=0)
+    # Assign a random, disjoint set of shards to each client in one permutation
+    shard_assignment = rng.permutation(num_shards)[:num_clients * shards_per_client]
+    shard_assignment = shard_assignment.reshape(num_clients, shards_per_client)
+    idxs_by_shard = idxs.reshape(num_shards, num_imgs)
+    dict_users = {i: idxs_by_shard[shard_assignment[i]].reshape(-1) for i in range(num_clients)}
 
     logging.info("Non-I.I.D data sampling completed.")
     return dict_users
 
+class EpochBatchSampler(Sampler):
+    """
+    Yield the batches of several epochs in a single pass.
+
+    Each epoch is a fresh permutation batched on its own, so batches never
+    straddle epoch boundaries and every epoch has the same number of steps as a
+    shuffled DataLoader would give.
+
+    :param num_samples: Number of samples in the dataset.
+    :param batch_size: Number of samples per batch.
+    :param epochs: Number of epochs to yield.
+    """
+    def __init__(self, num_samples: int, batch_size: int, epochs: int):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.epochs = epochs
+
+    def __iter__(self):
+        for _ in range(self.epochs):
+            permutation = torch.randperm(self.num_samples).tolist()
+            for start in range(0, self.num_samples, self.batch_size):
+                yield permutation[start:start + self.batch_size]
+
+    def __len__(self):
+        return self.epochs * -(-self.num_samples // self.batch_size)
+
+def configure_backends():
+    """
+    Enable faster CUDA kernels for training and evaluation.
+
+    Input shapes are fixed, so cuDNN benchmarking can pick the fastest (NHWC)
+    convolution algorithms, and TF32 tensor-core math is allowed for matmuls
+    and convolutions on Ampere+ GPUs.
+    """
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
+def autocast_dtype(device):
+    """
+    Pick the mixed-precision dtype for a device.
+
+    bfloat16 is used on GPUs with native support (compute capability 8.0+);
+    older GPUs fall back to float16, which needs a GradScaler during training.
+    Autocast is disabled on CPU, where bfloat16 is usually emulated.
+
+    :param device: Device the model runs on.
+    :return: torch.bfloat16, torch.float16, or None if autocast should be disabled.
+    """
+    device = torch.device(device)
+    if device.type != 'cuda':
+        return None
+    if torch.cuda.get_device_capability(device) >= (8, 0):
+        return torch.bfloat16
+    return torch.float16
+
 def evaluate_model(model, data_loader, device):
     """
     Evaluate a PyTorch model on a given dataset.
@@ -107,55 +154,119 @@ def evaluate_model(model, data_loader, device):
     :return: Tuple of (accuracy, average_loss) for the dataset.
     """
     model.eval()  # Set the model to evaluation mode
-    correct = 0
-    total_loss = 0.0
+    # Accumulate on-device to avoid a host sync per batch
+    correct = torch.zeros((), dtype=torch.long, device=device)
+    total_loss = torch.zeros((), device=device)
+    n_batches = 0
     criterion = nn.CrossEntropyLoss()
+    device_type = torch.device(device).type
+    amp_dtype = autocast_dtype(device)
 
-    with torch.no_grad():
+    with torch.inference_mode():
         for images, labels in data_loader:
-            images, labels = images.to(device), labels.to(device)
-            outputs = model(images)
-            loss = criterion(outputs, labels)
-            total_loss += loss.item()
-
-            _, predicted = torch.max(outputs, 1)
-            correct += (predicted == labels).sum().item()
+            images, labels = images.to(device, non_blocking=True), labels.to(device, non_blocking=True)
+            if images.dim() == 4:
+                images = images.to(memory_format=torch.channels_last)
+            with torch.autocast(device_type=device_type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                outputs = model(images)
+                loss = criterion(outputs, labels)
+            total_loss += loss
+            correct += (outputs.argmax(dim=1) == labels).sum()
+            n_batches += 1
 
+    # Single host sync for both accumulators
+    total_loss, correct = torch.stack([total_loss, correct.float()]).tolist()
     accuracy = correct / len(data_loader.dataset)
-    average_loss = total_loss / len(data_loader)
+    average_loss = total_loss / n_batches
 
     logging.info(f'Test Accuracy: {100 * accuracy:.2f}%')
     logging.info(f'Average Test Loss: {average_loss:.6f}')
 
     return accuracy, average_loss
 
+def quantize_int8(vector):
+    """
+    Symmetrically quantize a vector to INT8 with a single per-tensor scale.
+
+    :param vector: FP32 tensor to quantize.
+    :return: Tuple of (int8 tensor, fp32 scale).
+    """
+    # Clamp so an all-zero vector doesn't divide by zero
+    scale = vector.abs().max().clamp_min(1e-12) / 127
+    quantized = torch.round(vector / scale).to(torch.int8)
+    return quantized, scale
+
+def dequantize_int8(quantized, scale):
+    """
+    Recover an FP32 vector from its INT8 representation.
+
+    :param quantized: INT8 tensor produced by quantize_int8.
+    :param scale: FP32 scale produced by quantize_int8.
+    :return: FP32 tensor.
+    """
+    return quantized.to(torch.float32) * scale
+
+def sparsify_topk(delta, fraction):
+    """
+    Keep only the largest-magnitude entries of a client's update.
+
+    :param delta: Vector of the client's update (trained minus starting global parameters).
+    :param fraction: Fraction of entries of the update to keep, in (0, 1].
+    :return: Tuple of (int32 indices, int8 values, scale) describing the sparse update.
+    """
+    if not 0 < fraction <= 1:
+        raise ValueError(f"fraction must be in (0, 1], got {fraction}")
+    k = max(1, int(fraction * delta.numel()))
+    _, indices = torch.topk(delta.abs(), k)
+    quantized, scale = quantize_int8(delta[indices])
+    return indices.to(torch.int32), quantized, scale
+
 def aggregate_weights(existing_global_weights, local_weights):
     """
-    Aggregate local model weights into global weights by averaging.
+    Aggregate local updates into global weights by averaging.
+
+    Clients that sent no entry for a parameter are treated as leaving it
+    unchanged, so the result matches averaging the dense client vectors with
+    the global vector.
 
     :param existing_global_weights: Dict of global model parameters.
-    :param local_weights: List of vectors representing local model parameters from each client.
+    :param local_weights: List of updates from each client: dense delta vectors, (int8 vector, scale)
+                          pairs as returned by quantize_int8, or (indices, int8 values, scale)
+                          tuples as returned by sparsify_topk.
     :return: Dict of updated global model parameters.
     """
-    # Convert existing global weights to a single vector
-    global_vector = torch.cat([param.view(-1) for param in existing_global_weights.values()])
+    # Convert existing global weights to a single vector (reshape handles channels_last tensors)
+    global_vector = torch.cat([param.reshape(-1) for param in existing_global_weights.values()])
 
-    # Initialize the updated global vector with a copy of the global vector
-    updated_global_vector = global_vector.clone()
+    # Sort updates by format, dequantizing INT8 dense updates on receive
+    dense_updates, sparse_updates = [], []
+    for update in local_weights:
+        if isinstance(update, torch.Tensor):
+            dense_updates.append(update)
+        elif len(update) == 2:
+            dense_updates.append(dequantize_int8(*update))
+        else:
+            sparse_updates.append(update)
+
+    # Sum all dense updates in one reduction
+    if dense_updates:
+        aggregated_delta = torch.stack(dense_updates, dim=0).sum(dim=0)
+    else:
+        aggregated_delta = torch.zeros_like(global_vector)
 
-    # Aggregate local vectors into the updated global vector
-    for local_vector in local_weights:
-        updated_global_vector += local_vector
+    # Scatter all dequantized sparse updates in a single index_add_
+    if sparse_updates:
+        indices = torch.cat([indices for indices, _, _ in sparse_updates]).long()
+        values = torch.cat([dequantize_int8(quantized, scale) for _, quantized, scale in sparse_updates])
+        aggregated_delta.index_add_(0, indices, values)
 
-    # Average the parameters
-    updated_global_vector /= (len(local_weights) + 1)
+    # Average the updates together with the (unchanged) global vector
+    updated_global_vector = global_vector + aggregated_delta.div_(len(local_weights) + 1)
 
     # Convert the updated global vector back to the original parameter shapes
-    pointer = 0
-    updated_global_weights = {}
-    for name, param in existing_global_weights.items():
-        numel = param.numel()  # number of elements in this parameter
-        updated_global_weights[name] = updated_global_vector[pointer:pointer + numel].view(param.shape)
-        pointer += numel
+    chunks = torch.split(updated_global_vector,
+                         [param.numel() for param in existing_global_weights.values()])
+    updated_global_weights = {name: chunk.view_as(param)
+                              for (name, param), chunk in zip(existing_global_weights.items(), chunks)}
 
     return updated_global_weights
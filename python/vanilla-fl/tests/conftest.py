@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The sources are run as scripts from src/, so make their modules importable
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
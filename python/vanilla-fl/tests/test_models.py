@@ -0,0 +1,20 @@
+import torch
+from models import CNNMnist
+
+
+def test_weights_to_vector_round_trip_channels_last():
+    torch.manual_seed(0)
+    source = CNNMnist().to(memory_format=torch.channels_last)
+    vector = source.weights_to_vector().clone()
+
+    # Flattened in logical (NCHW) order regardless of memory format
+    expected = torch.cat([param.detach().reshape(-1) for param in source.parameters()])
+    assert torch.equal(vector, expected)
+
+    target = CNNMnist().to(memory_format=torch.channels_last)
+    target.vector_to_weights(vector)
+
+    for source_param, target_param in zip(source.parameters(), target.parameters()):
+        assert torch.equal(source_param, target_param)
+    assert target.conv1.weight.is_contiguous(memory_format=torch.channels_last)
+    assert torch.equal(target.weights_to_vector(), vector)
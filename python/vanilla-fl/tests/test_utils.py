@@ -0,0 +1,54 @@
+import pytest
+import torch
+from models import CNNMnist
+import utils
+
+NUM_CLIENTS = 3
+
+
+def make_round():
+    """Return the global state dict, its vector, and trained-looking local vectors."""
+    torch.manual_seed(0)
+    global_model = CNNMnist().to(memory_format=torch.channels_last)
+    global_vector = global_model.weights_to_vector().clone()
+    local_vectors = [global_vector + 0.01 * torch.randn_like(global_vector) for _ in range(NUM_CLIENTS)]
+    return global_model.state_dict(), global_vector, local_vectors
+
+
+def expected_weights(global_weights, global_vector, local_vectors):
+    """Baseline FedAvg result: (global + sum(local)) / (K + 1), reshaped per parameter."""
+    averaged = (global_vector + torch.stack(local_vectors).sum(dim=0)) / (len(local_vectors) + 1)
+    chunks = torch.split(averaged, [param.numel() for param in global_weights.values()])
+    return {name: chunk.view_as(param) for (name, param), chunk in zip(global_weights.items(), chunks)}
+
+
+def test_aggregate_weights_dense_matches_baseline():
+    global_weights, global_vector, local_vectors = make_round()
+    deltas = [local_vector - global_vector for local_vector in local_vectors]
+
+    updated = utils.aggregate_weights(global_weights, deltas)
+    expected = expected_weights(global_weights, global_vector, local_vectors)
+
+    assert updated.keys() == expected.keys()
+    for name in expected:
+        torch.testing.assert_close(updated[name], expected[name])
+
+
+def test_aggregate_weights_topk_full_fraction_matches_baseline():
+    global_weights, global_vector, local_vectors = make_round()
+    deltas = [local_vector - global_vector for local_vector in local_vectors]
+
+    updated = utils.aggregate_weights(global_weights,
+                                      [utils.sparsify_topk(delta, 1.0) for delta in deltas])
+    expected = expected_weights(global_weights, global_vector, local_vectors)
+
+    # INT8 rounding error is at most half a quantization step per client
+    atol = max(delta.abs().max().item() for delta in deltas) / 127
+    for name in expected:
+        torch.testing.assert_close(updated[name], expected[name], atol=atol, rtol=0)
+
+
+@pytest.mark.parametrize('fraction', [0, -0.1, 1.5])
+def test_sparsify_topk_rejects_invalid_fraction(fraction):
+    with pytest.raises(ValueError):
+        utils.sparsify_topk(torch.randn(10), fraction)